@@ -2,147 +2,460 @@
 
 import csv
 import argparse
-from collections import deque
+import importlib
+import importlib.machinery
+import importlib.util
+import marshal
+import mmap
+import os
+import sys
+from array import array
+from functools import lru_cache
+from itertools import islice, repeat
+from math import isfinite
+from operator import eq, itemgetter, mul, or_, truediv
+from typing import BinaryIO, Iterable, Iterator, NamedTuple
 
-class Trade:
-    """ 
-    As a class this represents a single trade, essentially a row in the csv.
-    This class is immutable after construction.
+# how many characters of an unquoted csv are read and parsed at a time
+READ_CHUNK_SIZE = 1 << 20
+# how many rows of a quoted csv are read and parsed at a time
+CSV_CHUNK_ROWS = 1 << 14
+# units are stored as whole millionths of a share so they add up exactly,
+# so quantities are rounded to 6 decimals and anything below half a
+# millionth of a share can't be represented
+UNIT_SCALE = 1_000_000
+# bumped whenever the layout of Trades changes, invalidating old caches
+CACHE_VERSION = 3
+
+class Trades(NamedTuple):
+    """
+    The trades of a csv stored column-wise, row i of the csv being index i
+    of every column. Symbols are stored once each and referred to by id.
+    """
+    symbols: list[str]  # each unique stock symbol, indexed by id
+    units: array        # 'q', in millionths of a share, always positive
+    values: array       # 'q', the total value of each trade in cents
+    is_buy: array       # 'b', 1 for a buy and 0 for a sell
+    sym_ids: array      # 'i', the id of each trade's symbol
+
+class FifoArena:
+    """
+    The open buy lots of a single stock, oldest first. Lots are stored
+    column-wise and sold off by advancing head rather than popping.
     """
-    __slots__ = ("stockType_", "units_", "isBuy_", "value_", "_frozen")
-
-    def __init__(self, stockType:str, units:float, isBuy:bool, value:float):
-        object.__setattr__(self, "stockType_", stockType)
-        object.__setattr__(self, "units_", units)
-        object.__setattr__(self, "isBuy_", isBuy)
-        object.__setattr__(self, "value_", value)
-        object.__setattr__(self, "_frozen", True)
-
-    def __setattr__(self, name:str, value):
-        if getattr(self, "_frozen", False):
-            raise AttributeError(f"{self.__class__.__name__} is immutable")
-        object.__setattr__(self, name, value)
-
-    def __str__(self) -> str:
-        side = "Buy" if self.isBuy_ else "Sell"
-        return f"Trade(stockType={self.stockType_}, units={self.units_}, side={side}, value={self.value_})"
-
-def find_col(key:str, heading:list[str]) -> int:
-    """ Finds the column associated with a given keyword.
+    __slots__ = ("units", "prices", "head")
+
+    def __init__(self) -> None:
+        self.units = array('q')  # millionths of a share left in each lot
+        self.prices = array('q') # cents per unit of each lot
+        self.head = 0            # index of the oldest lot not fully sold
+
+    def push(self, units:int, price:int) -> None:
+        """ Adds a lot to the back of the queue. """
+        self.units.append(units)
+        self.prices.append(price)
+
+    def advance(self, head:int) -> None:
+        """ Moves the front of the queue to head, dropping the sold lots
+        once they make up over half the buffer.
+        """
+        if head > 32 and head * 2 > len(self.units):
+            del self.units[:head]
+            del self.prices[:head]
+            head = 0
+        self.head = head
+
+@lru_cache(maxsize=None)
+def find_cols(keys:tuple[str, ...], heading:tuple[str, ...]) -> tuple[int, ...]:
+    """ Finds the columns associated with each keyword in a single pass over
+    the heading. Results are cached per heading.
     
     Keyword Arguments:
-        key -- a text keyword in a column
+        keys -- the text keywords to look for in the columns
         heading -- the row being analyzed (meant for the heading of the csv)
 
     Returns:
-        index:int -- the index of the column
+        indices:tuple[int, ...] -- the index of the first column containing
+            each key, in the order of keys
     """
+    found:dict[str, int] = {}
     for index, x in enumerate(heading):
-        if key in x:
-            return index
-    raise ValueError(f"Heading '{key}' not found in CSV")
+        for key in keys:
+            if key not in found and key in x:
+                found[key] = index
+
+    for key in keys:
+        if key not in found:
+            raise ValueError(f"Heading '{key}' not found in CSV")
+    return tuple(found[key] for key in keys)
+
+def iter_rows(filename:str) -> Iterator[list[list[str]]]:
+    """Reads the rows of the csv a chunk at a time, starting with the heading.
+
+    Files without any quotes are read in blocks and split on newlines and
+    commas directly, anything else goes through the csv module.
+
+    Keyword Arguments:
+        filename -- the name of the csv file
+
+    Yields:
+        rows:list[list[str]] -- the next chunk of rows of the csv
+
+    Exceptions:
+        FileNotFoundError
+    """
+    with open(filename, 'rb') as csvfile:
+        quoted = False
+        if os.fstat(csvfile.fileno()).st_size > 0:
+            with mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                quoted = buf.find(b'"') != -1
+
+    if quoted:
+        with open(filename, newline='') as csvfile:
+            reader = csv.reader(csvfile, delimiter=',')
+            while rows := list(islice(reader, CSV_CHUNK_ROWS)):
+                yield rows
+        return
+
+    with open(filename) as csvfile:
+        rest = '' # the unfinished last line of the previous block
+        while block := csvfile.read(READ_CHUNK_SIZE):
+            lines = (rest + block).split('\n')
+            rest = lines.pop()
+            if lines:
+                yield list(map(str.split, lines, repeat(',')))
+        if rest:
+            yield [rest.split(',')]
 
-def lex_csv(filename:str) -> list[Trade]:
-    """Turns the csv into a list of 'Trade' objects.
+def iter_columns(filename:str, keys:tuple[str, ...]) -> Iterator[list[tuple[str, ...]]]:
+    """Reads the columns of the csv matching each keyword a chunk of rows at
+    a time, skipping the rest.
+
+    Keyword Arguments:
+        filename -- the name of the csv file
+        keys -- text keywords for the columns to read
+
+    Yields:
+        columns:list[tuple[str, ...]] -- the cells of each column for the
+            next chunk of rows below the heading, in the order of keys
+
+    Exceptions:
+        FileNotFoundError
+        ValueError
+    """
+    getCells = None
+    for rows in iter_rows(filename):
+        if getCells is None:
+            getCells = itemgetter(*find_cols(keys, tuple(rows[0])))
+            del rows[0]
+
+        # only the needed cells of each row are kept, then the columns are
+        # pulled out with C level map/zip passes rather than parsing each
+        # row in an interpreted loop
+        if rows:
+            yield list(zip(*map(getCells, rows)))
+
+    if getCells is None:
+        raise ValueError("No heading found in CSV")
+
+def iter_trades(filename:str) -> Iterator[Trades]:
+    """Turns the csv into columns of trades a chunk of rows at a time, so the
+    whole file is never held in memory. Symbol ids are shared between chunks.
     
     Keyword Arguments:
         filename -- the name of the csv file
 
-    Returns:
-        trades:list[Trade]  -- A list of trade objects representing
-            each column of the csv.
+    Yields:
+        trades:Trades -- the columns of the next chunk of the csv, each row
+            being a single trade. The symbols are every symbol seen so far.
 
     Exceptions:
         FileNotFoundError
-        StopIteration
         ValueError
     """
-    with open(filename, newline='') as csvfile:
-        reader = csv.reader(csvfile, delimiter=',')
-        
-        heading = next(reader)
-        stockSymbolCol = find_col("Symbol", heading)
-        totalValueCol = find_col("Total Value", heading)
-        sideCol = find_col("Side" ,heading)
-        unitsCol = find_col("Units", heading)
-        
-        tradeList:list[Trade] = []
-        for row in reader:
-            isBuy:bool|None = None
-            value:float = float(row[totalValueCol])
-            symbol:str = row[stockSymbolCol]
-            units:float = abs(float(row[unitsCol]))
-
-            if "Buy" in row[sideCol]:
-                isBuy = True
-            elif "Sell" in row[sideCol]:
-                isBuy = False
-            else:
+    symbolIds:dict[str, int] = {}
+    for symbolCol, unitsStrs, valueStrs, sides in iter_columns(
+            filename, ("Symbol", "Units", "Total Value", "Side")):
+        unitsFloats = array('d', map(abs, map(float, unitsStrs)))
+        valueFloats = array('d', map(float, valueStrs))
+        if not all(map(isfinite, unitsFloats)):
+            raise ValueError("Failed to parse 'Units'")
+        if not all(map(isfinite, valueFloats)):
+            raise ValueError("Failed to parse 'Total Value'")
+
+        try:
+            units = array('q', map(round, map(mul, unitsFloats, repeat(UNIT_SCALE))))
+        except OverflowError:
+            raise ValueError("Failed to parse 'Units'")
+        try:
+            values = array('q', map(round, map(mul, valueFloats, repeat(100))))
+        except OverflowError:
+            raise ValueError("Failed to parse 'Total Value'")
+        if 0 in units:
+            raise ValueError(f"Failed to parse 'Units', quantities must be at least "
+                             f"{1 / UNIT_SCALE:f} shares")
+
+        # sides are almost always exactly "Buy" or "Sell", so try a plain
+        # compare before falling back to searching each side for them
+        isBuy = array('b', map(eq, sides, repeat("Buy")))
+        isSell = map(eq, sides, repeat("Sell"))
+        if not all(map(or_, isBuy, isSell)):
+            isBuy = array('b', map(str.__contains__, sides, repeat("Buy")))
+            isSell = map(str.__contains__, sides, repeat("Sell"))
+            if not all(map(or_, isBuy, isSell)):
                 raise ValueError("Failed to parse 'Side'")
 
-            tradeList.append(Trade(symbol, units, isBuy, value))
+        for symbol in dict.fromkeys(symbolCol):
+            symbolIds.setdefault(symbol, len(symbolIds))
+        symIds = array('i', map(symbolIds.__getitem__, symbolCol))
+
+        yield Trades(list(symbolIds), units, values, isBuy, symIds)
+
+def load_chunk(cache:BinaryIO) -> Trades:
+    """ Reads the next chunk of trades written by iter_cached_trades().
+
+    Keyword Arguments:
+        cache -- the cache file, positioned at a chunk
+
+    Returns:
+        trades:Trades -- the chunk of trades
+
+    Exceptions:
+        EOFError
+        ValueError
+        TypeError
+    """
+    symbols, units, values, isBuy, symIds = marshal.load(cache)
+    trades = Trades(list(symbols), array('q', units), array('q', values),
+                    array('b', isBuy), array('i', symIds))
+    if not len(trades.units) == len(trades.values) == len(trades.is_buy) == len(trades.sym_ids):
+        raise ValueError("Cache chunk columns differ in length")
+    if trades.sym_ids and not 0 <= min(trades.sym_ids) <= max(trades.sym_ids) < len(trades.symbols):
+        raise ValueError("Cache chunk has unknown symbol ids")
+    return trades
+
+def open_cache(cacheName:str, key:tuple[int, ...]) -> tuple[BinaryIO, int]|None:
+    """ Opens a cache file written by iter_cached_trades(), if it exists, was
+    made with the same key and was written out in full. The whole cache is
+    checked before anything is read from it, so a broken cache is never
+    half used.
+
+    Keyword Arguments:
+        cacheName -- the name of the cache file
+        key -- the key the cache has to match
+
+    Returns:
+        cache:BinaryIO, chunkCount:int -- the cache positioned at its first
+            chunk and the number of chunks in it, or None if there is no
+            usable cache
+    """
+    try:
+        cache = open(cacheName, 'rb')
+    except OSError:
+        return None
+
+    try:
+        if marshal.load(cache) != key:
+            cache.close()
+            return None
+    except (EOFError, ValueError, TypeError):
+        cache.close()
+        return None
+
+    try:
+        start = cache.tell()
+
+        # the chunks are followed by a count of them, which is only written
+        # once the cache is complete
+        chunkCount = 0
+        while True:
+            chunkStart = cache.tell()
+            if isinstance(marshal.load(cache), int):
+                break
+            cache.seek(chunkStart)
+            load_chunk(cache)
+            chunkCount += 1
+
+        cache.seek(chunkStart)
+        if marshal.load(cache) == chunkCount and cache.read(1) == b'':
+            cache.seek(start)
+            return cache, chunkCount
+    except (EOFError, ValueError, TypeError):
+        pass
+
+    # the cache is for this csv but is broken, so it's of no further use
+    cache.close()
+    try:
+        os.remove(cacheName)
+    except OSError:
+        pass
+    return None
+
+def iter_cached_trades(filename:str) -> Iterator[Trades]:
+    """Same as iter_trades(), but the parsed trades are also saved to a
+    '.cache' file next to the csv and read back from there on later runs,
+    as long as the csv's modification time and size haven't changed.
+
+    Keyword Arguments:
+        filename -- the name of the csv file
 
-        return tradeList
+    Yields:
+        trades:Trades -- the columns of the next chunk of the csv
 
-def calculate_capital_gains(trades:list[Trade]) -> tuple[float, float]:
-    """Tax a list of 'Trade' objects and calculates net gains and total gains.
+    Exceptions:
+        FileNotFoundError
+        ValueError
+    """
+    stat = os.stat(filename)
+    key = (CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+    cacheName = filename + ".cache"
+
+    opened = open_cache(cacheName, key)
+    if opened is not None:
+        cached, chunkCount = opened
+        with cached:
+            for _ in range(chunkCount):
+                yield load_chunk(cached)
+        return
+
+    # written to a temporary file and renamed once complete, so a cache is
+    # never left half written. The cache is optional, so if it can't be
+    # written (no permission, disk full, ...) the trades are still yielded
+    tmpName = f"{cacheName}.{os.getpid()}.tmp"
+    cache:BinaryIO|None = None
+    try:
+        cache = open(tmpName, 'wb')
+        marshal.dump(key, cache)
+    except OSError:
+        cache = None
+
+    try:
+        chunkCount = 0
+        for trades in iter_trades(filename):
+            if cache is not None:
+                try:
+                    marshal.dump((trades.symbols, trades.units.tobytes(), trades.values.tobytes(),
+                                  trades.is_buy.tobytes(), trades.sym_ids.tobytes()), cache)
+                except OSError:
+                    cache.close()
+                    cache = None
+            chunkCount += 1
+            yield trades
+
+        if cache is not None:
+            try:
+                marshal.dump(chunkCount, cache)
+                cache.close()
+                os.replace(tmpName, cacheName)
+            except OSError:
+                pass
+    finally:
+        if cache is not None:
+            try:
+                cache.close()
+            except OSError:
+                pass
+        if os.path.exists(tmpName):
+            try:
+                os.remove(tmpName)
+            except OSError:
+                pass
+
+def calculate_capital_gains(chunks:Iterable[Trades]) -> tuple[float, float]:
+    """Tax the trades and calculates net gains and total gains. Holdings are
+    carried over from one chunk of trades to the next.
     
     Keyword Arguments:
-        trades:list[Trade] -- a list of trade objects, ideally from lex_csv()
+        chunks:Iterable[Trades] -- chunks of trades, ideally from iter_trades()
 
     Returns:
         net_gains:float, total_gains:float -- the net, then total gains
     """
-    # stock -> deque of (units, price per unit)
-    holdings: dict[str, deque[tuple[float,float]]] = {}
-    total_gains = 0.0
-    net_gains = 0.0
-
-    for trade in trades:
-        symbol = trade.stockType_
-        if symbol not in holdings:
-            holdings[symbol] = deque()
-
-        if trade.isBuy_: # tracking holdings on buys
-            price_per_unit = round(trade.value_ / trade.units_, 2)
-            holdings[symbol].append((trade.units_, price_per_unit))
-        else: # calculating gains on sell
-            units_to_sell = trade.units_
-            sell_price_per_unit = round(trade.value_ / trade.units_, 2)
-
-            while units_to_sell > 0 and holdings[symbol]:
-                buy_units, buy_price_per_unit = holdings[symbol][0]
-
-                if buy_units <= units_to_sell:
-                    gain = round((sell_price_per_unit - buy_price_per_unit) * buy_units, 2)
-                    net_gains += gain
-                    if gain >= 0:
-                        total_gains += gain
-
-                    units_to_sell -= buy_units
-                    holdings[symbol].popleft()
-                else:
-                    gain = round((sell_price_per_unit - buy_price_per_unit) * units_to_sell, 2)
-                    net_gains += gain
-                    if gain >= 0:
-                        total_gains += gain
-
-                    holdings[symbol][0] = (buy_units - units_to_sell, buy_price_per_unit)
-                    units_to_sell = 0
-
-    return round(net_gains, 2), round(total_gains, 2)
+    # money is tracked in whole cents so the sums stay exact
+    holdings:list[FifoArena] = [] # indexed by symbol id
+    total_gains = 0
+    net_gains = 0
+    round_ = round
+
+    for trades in chunks:
+        holdings.extend(FifoArena() for _ in range(len(holdings), len(trades.symbols)))
+
+        # every trade's price per share rounded to the cent, worked out in one
+        # pass of C level maps rather than inside the loop
+        scaledValues = map(mul, trades.values, repeat(UNIT_SCALE))
+        prices = array('q', map(round, map(truediv, scaledValues, trades.units)))
+
+        for symId, units, price, isBuy in zip(trades.sym_ids, trades.units,
+                                              prices, trades.is_buy):
+            arena = holdings[symId]
+
+            if isBuy: # tracking holdings on buys
+                arena.push(units, price)
+            else: # calculating gains on sell
+                units_to_sell:int = units
+                sell_price_per_unit:int = price
+
+                lotUnits = arena.units
+                lotPrices = arena.prices
+                head:int = arena.head
+                lotCount:int = len(lotUnits)
+                while units_to_sell > 0 and head < lotCount:
+                    buy_units:int = lotUnits[head]
+                    buy_price_per_unit:int = lotPrices[head]
+
+                    if buy_units <= units_to_sell:
+                        gain = round_((sell_price_per_unit - buy_price_per_unit) * buy_units / UNIT_SCALE)
+                        net_gains += gain
+                        if gain > 0:
+                            total_gains += gain
+
+                        units_to_sell -= buy_units
+                        head += 1
+                    else:
+                        gain = round_((sell_price_per_unit - buy_price_per_unit) * units_to_sell / UNIT_SCALE)
+                        net_gains += gain
+                        if gain > 0:
+                            total_gains += gain
+
+                        lotUnits[head] = buy_units - units_to_sell
+                        units_to_sell = 0
+                arena.advance(head)
+
+    return net_gains / 100, total_gains / 100
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser(
         prog="Stake - Captial Gains Calculator",
         description="calculates your capital gains based on a stake tax csv")
     argparser.add_argument('filename')
+    argparser.add_argument('--no-cache', action='store_true',
+        help="don't read or write the parsed csv cache next to the csv")
     args = argparser.parse_args()
 
+    # prefer a mypyc compiled build of this file when one has been made
+    # (see README), otherwise keep using this module as it is. The build is
+    # only trusted if it sits next to this file and isn't older than it, so
+    # a stale or unrelated build never runs in place of this code
+    cgcalc = sys.modules[__name__]
+    try:
+        spec = importlib.util.find_spec("cgcalc")
+        if (spec is not None and spec.origin is not None
+                and isinstance(spec.loader, importlib.machinery.ExtensionFileLoader)
+                and os.path.dirname(os.path.realpath(spec.origin))
+                    == os.path.dirname(os.path.realpath(__file__))
+                and os.path.getmtime(spec.origin) >= os.path.getmtime(__file__)):
+            cgcalc = importlib.import_module("cgcalc")
+    except (ImportError, OSError):
+        pass
+
     try:
-        net, total = calculate_capital_gains(lex_csv(args.filename))
+        if args.no_cache:
+            trades = cgcalc.iter_trades(args.filename)
+        else:
+            trades = cgcalc.iter_cached_trades(args.filename)
+        net, total = cgcalc.calculate_capital_gains(trades)
         print("Net Capital Gains is: ", net)
         print("Total Capital Gains is: ", total)
-    except (FileNotFoundError, StopIteration, ValueError) as e:
+    except (FileNotFoundError, ValueError) as e:
         print(e)
 